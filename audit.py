@@ -0,0 +1,116 @@
+import os
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime, timezone
+
+import crud
+from database import get_async_db
+
+logger = logging.getLogger(__name__)
+
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", 500))
+AUDIT_FLUSH_INTERVAL_SECONDS = float(os.getenv("AUDIT_FLUSH_INTERVAL_SECONDS", 2))
+AUDIT_MAX_BUFFER = int(os.getenv("AUDIT_MAX_BUFFER", 50000))
+
+
+class AuditLog:
+    """
+    In-process buffer for audit events.
+    record() only appends to memory, so it is safe to call once per send on the
+    broadcast path. A background task flushes the buffer with one multi-row INSERT
+    whenever it reaches batch_size rows or flush_interval seconds have passed.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = AUDIT_BATCH_SIZE,
+        flush_interval: float = AUDIT_FLUSH_INTERVAL_SECONDS,
+        max_buffer: int = AUDIT_MAX_BUFFER,
+    ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # If the database is down we keep the newest events and drop the oldest.
+        self._buffer: deque[dict] = deque(maxlen=max_buffer)
+        # Drops are counted here and logged once per flush attempt, not once per event.
+        self._dropped = 0
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    def record(self, event_type: str, rebalance_id: str | None = None, chat_id: int | None = None, **detail) -> None:
+        """Queues one audit event. Never blocks and never touches the database."""
+        if len(self._buffer) == self._buffer.maxlen:
+            self._dropped += 1
+        self._buffer.append({
+            "event_type": event_type,
+            "rebalance_id": rebalance_id,
+            "chat_id": chat_id,
+            "detail": detail or None,
+            "created_at": datetime.now(timezone.utc),
+        })
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self) -> int:
+        """Writes everything currently buffered. Returns the number of rows written."""
+        async with self._flush_lock:
+            if self._dropped:
+                logger.warning(f"AUDIT: Buffer full, dropped {self._dropped} oldest events since the last flush.")
+                self._dropped = 0
+            if not self._buffer:
+                return 0
+            batch = list(self._buffer)
+            self._buffer.clear()
+            try:
+                async with get_async_db() as db:
+                    written = await asyncio.to_thread(crud.create_audit_events, db, batch)
+                logger.debug(f"AUDIT: Flushed {written} events.")
+                return written
+            except Exception as e:
+                logger.error(f"AUDIT: Failed to flush {len(batch)} events: {e}", exc_info=True)
+                # Put the batch back in front of anything recorded meanwhile so it is retried
+                # on the next flush. If that no longer fits, drop the oldest events.
+                pending = batch + list(self._buffer)
+                dropped = max(0, len(pending) - self._buffer.maxlen)
+                if dropped:
+                    logger.warning(f"AUDIT: Buffer full, dropping {dropped} oldest events.")
+                self._buffer.clear()
+                self._buffer.extend(pending[dropped:])
+                return 0
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self) -> None:
+        """Starts the background flusher on the running event loop."""
+        if self._task is None:
+            # Recreated here so the primitives belong to the loop that runs the flusher.
+            self._wakeup = asyncio.Event()
+            self._flush_lock = asyncio.Lock()
+            self._task = asyncio.create_task(self._run())
+            logger.info(
+                f"AUDIT: Flusher started (batch size {self.batch_size}, interval {self.flush_interval}s)."
+            )
+
+    async def stop(self) -> None:
+        """Stops the background flusher and writes whatever is left in the buffer."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        logger.info("AUDIT: Flusher stopped.")
+
+
+# Shared by the API process and the worker; each starts and stops it in its own lifecycle hooks.
+audit_log = AuditLog()
@@ -1,5 +1,8 @@
 # crud.py
+from sqlalchemy import and_, case, exists, insert, or_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
+from datetime import datetime
 import models
 import schemas
 
@@ -24,6 +27,111 @@ def get_all_user_ids(db: Session) -> list[int]:
     # We use a list comprehension to flatten it into [123, 456]
     return [user_id for user_id, in db.query(models.User.chat_id).all()]
 
+def get_recipients(db: Session, token_symbol: str, protocols: list[str], amount: float, hour: int) -> list[tuple[int, bool]]:
+    """
+    Resolves who should receive a rebalance event, in one query.
+    A user matches when, for each filter they have set, the event passes it:
+    token subscribed with the amount at least that token's min_amount, and one
+    of the event's protocols subscribed. Users with no preferences match every event.
+    Returns (chat_id, silent) pairs; silent is True when the current UTC hour is
+    inside the user's quiet hours, so the message should be sent without a notification.
+    """
+    User, Pref, Sub = models.User, models.UserPreference, models.UserSubscription
+
+    def passes(kind: str, values: list[str], *extra):
+        has_filter = exists().where(Sub.chat_id == User.chat_id, Sub.kind == kind)
+        has_match = exists().where(
+            Sub.chat_id == User.chat_id, Sub.kind == kind, Sub.value.in_([v.lower() for v in values]), *extra
+        )
+        return or_(~has_filter, has_match)
+
+    start, end = Pref.mute_start_hour, Pref.mute_end_hour
+    in_mute_window = or_(
+        and_(start <= end, start <= hour, end > hour),
+        and_(start > end, or_(start <= hour, end > hour)),
+    )
+    silent = case((and_(start.isnot(None), end.isnot(None), in_mute_window), True), else_=False)
+    query = (
+        db.query(User.chat_id, silent)
+        .outerjoin(Pref, Pref.chat_id == User.chat_id)
+        .filter(
+            passes("token", [token_symbol], or_(Sub.min_amount.is_(None), Sub.min_amount <= amount)),
+            passes("protocol", protocols),
+        )
+    )
+    return [(user_id, bool(is_silent)) for user_id, is_silent in query.all()]
+
+def get_user_preferences(db: Session, chat_id: int) -> schemas.UserPreferences:
+    """Returns a user's broadcast filters, with defaults if none have been set."""
+    subs = db.query(models.UserSubscription).filter(models.UserSubscription.chat_id == chat_id).all()
+    pref = db.query(models.UserPreference).filter(models.UserPreference.chat_id == chat_id).first()
+    return schemas.UserPreferences(
+        tokens=sorted(s.value for s in subs if s.kind == "token"),
+        protocols=sorted(s.value for s in subs if s.kind == "protocol"),
+        token_min_amounts={s.value: s.min_amount for s in subs if s.kind == "token" and s.min_amount},
+        mute_start_hour=pref.mute_start_hour if pref else None,
+        mute_end_hour=pref.mute_end_hour if pref else None,
+    )
+
+def toggle_user_subscription(db: Session, chat_id: int, kind: str, value: str) -> bool:
+    """
+    Adds the subscription if missing, removes it if present. Returns True if now subscribed.
+    Safe against a concurrent toggle of the same row (e.g. a double tap).
+    """
+    value = value.lower()
+    deleted = db.query(models.UserSubscription).filter(
+        models.UserSubscription.chat_id == chat_id,
+        models.UserSubscription.kind == kind,
+        models.UserSubscription.value == value,
+    ).delete()
+    db.commit()
+    if deleted:
+        return False
+    try:
+        db.add(models.UserSubscription(chat_id=chat_id, kind=kind, value=value))
+        db.commit()
+    except IntegrityError:
+        # A concurrent toggle inserted the same row first; the end state is the same.
+        db.rollback()
+    return True
+
+def set_token_min_amount(db: Session, chat_id: int, token: str, min_amount: float | None) -> bool:
+    """
+    Sets the minimum amount (in units of the token) for a subscribed token.
+    Returns False if the user is not subscribed to that token.
+    """
+    updated = db.query(models.UserSubscription).filter(
+        models.UserSubscription.chat_id == chat_id,
+        models.UserSubscription.kind == "token",
+        models.UserSubscription.value == token.lower(),
+    ).update({models.UserSubscription.min_amount: min_amount})
+    db.commit()
+    return bool(updated)
+
+def update_user_preferences(db: Session, chat_id: int, **fields) -> models.UserPreference:
+    """Creates or updates a user's mute window."""
+    for _ in range(2):
+        db_pref = db.query(models.UserPreference).filter(models.UserPreference.chat_id == chat_id).first()
+        if not db_pref:
+            db_pref = models.UserPreference(chat_id=chat_id)
+            db.add(db_pref)
+        for key, value in fields.items():
+            setattr(db_pref, key, value)
+        try:
+            db.commit()
+            break
+        except IntegrityError:
+            # A concurrent tap created the row first; update that one instead.
+            db.rollback()
+    db.refresh(db_pref)
+    return db_pref
+
+def reset_user_preferences(db: Session, chat_id: int) -> None:
+    """Removes all filters so the user receives every rebalance again."""
+    db.query(models.UserSubscription).filter(models.UserSubscription.chat_id == chat_id).delete()
+    db.query(models.UserPreference).filter(models.UserPreference.chat_id == chat_id).delete()
+    db.commit()
+
 def remove_user(db: Session, chat_id: int) -> bool:
     """Removes a user by chat_id. Returns True if deleted, False if not found."""
     db_user = db.query(models.User).filter(models.User.chat_id == chat_id).first()
@@ -51,3 +159,57 @@ def create_rebalance_event(db: Session, event: schemas.RebalanceEventCreate) ->
     db.commit()
     db.refresh(db_event)
     return db_event
+
+def create_audit_events(db: Session, events: list[dict]) -> int:
+    """
+    Bulk-inserts a batch of audit event rows in a single statement.
+    Takes plain dicts (see AuditLog.record) to keep the hot path free of ORM objects.
+    Returns the number of rows written.
+    """
+    if not events:
+        return 0
+    db.execute(insert(models.AuditEvent), events)
+    db.commit()
+    return len(events)
+
+def get_audit_events(
+    db: Session, event_type: str, since: datetime | None = None, until: datetime | None = None, limit: int | None = None
+) -> list[models.AuditEvent]:
+    """Returns audit events of one type, oldest first, optionally bounded by time."""
+    query = db.query(models.AuditEvent).filter(models.AuditEvent.event_type == event_type)
+    if since:
+        query = query.filter(models.AuditEvent.created_at >= since)
+    if until:
+        query = query.filter(models.AuditEvent.created_at < until)
+    query = query.order_by(models.AuditEvent.created_at, models.AuditEvent.id)
+    if limit:
+        query = query.limit(limit)
+    return query.all()
+
+def get_existing_rebalance_ids(db: Session, rebalance_ids: list[str]) -> set[str]:
+    """Returns the subset of rebalance_ids that already have a RebalanceEvent row."""
+    rows = db.query(models.RebalanceEvent.rebalance_id).filter(models.RebalanceEvent.rebalance_id.in_(rebalance_ids))
+    return {rebalance_id for rebalance_id, in rows.all()}
+
+def delete_rebalance_events(db: Session, rebalance_ids: list[str]) -> int:
+    """Deletes RebalanceEvent rows by rebalance_id. Returns the number deleted."""
+    deleted = db.query(models.RebalanceEvent).filter(
+        models.RebalanceEvent.rebalance_id.in_(rebalance_ids)
+    ).delete(synchronize_session=False)
+    db.commit()
+    return deleted
+
+def delete_users(db: Session, chat_ids: list[int]) -> int:
+    """Deletes users (and, through the foreign keys, their preferences). Returns the number deleted."""
+    deleted = db.query(models.User).filter(models.User.chat_id.in_(chat_ids)).delete(synchronize_session=False)
+    db.commit()
+    return deleted
+
+def delete_audit_events(db: Session, rebalance_ids: list[str], since: datetime) -> int:
+    """Deletes audit events for the given rebalance_ids recorded at or after `since`."""
+    deleted = db.query(models.AuditEvent).filter(
+        models.AuditEvent.rebalance_id.in_(rebalance_ids),
+        models.AuditEvent.created_at >= since,
+    ).delete(synchronize_session=False)
+    db.commit()
+    return deleted
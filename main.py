@@ -1,16 +1,18 @@
 import os
 import asyncio
+import hashlib
 import json
 from typing import List, Dict, Any
 import logging
 from contextlib import asynccontextmanager
 from database import get_async_db
 
-from fastapi import FastAPI, Depends, HTTPException, status, Header, Request
+from fastapi import FastAPI, Depends, HTTPException, status, Header, Request, Query
 from sqlalchemy.orm import Session
 from pydantic import BaseModel, Field
 
 from telegram.constants import ChatAction 
+from telegram.error import BadRequest
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
 
@@ -21,13 +23,17 @@ import httpx
 import crud
 import models
 import schemas
+from audit import audit_log
+import profiling
+from profiling import loop_monitor, timed_handler
 from database import SessionLocal, engine
 
 from functools import lru_cache
-from datetime import datetime
+from datetime import datetime, timezone
 
 last_fetch = None
 cached_metrics = None
+cached_vault_data = None
 CACHE_DURATION = 60  
 cache_lock = asyncio.Lock()
 
@@ -63,8 +69,15 @@ WEBHOOK_API_KEY = os.getenv("WEBHOOK_API_KEY", "your-secret-key-here")
 if not TELEGRAM_TOKEN:
     raise ValueError("TELEGRAM_BOT_TOKEN environment variable not set!")
 
+PERMANENT_REPLY_MARKUP = ReplyKeyboardMarkup([[KeyboardButton("📊 Neura Metrics")]], resize_keyboard=True)
+METRICS_INLINE_MARKUP = InlineKeyboardMarkup([[
+    InlineKeyboardButton("🔄 Refresh", callback_data='refresh_metrics'),
+    InlineKeyboardButton("🔔 Preferences", callback_data='pref:open'),
+]])
+METRICS_HASHES_PER_CHAT = 10
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handles the /start command by sending a welcome message with an INLINE keyboard."""
+    """Handles the /start command by sending a welcome message with the PERMANENT keyboard."""
     chat_id = update.message.chat_id
     '''db = SessionLocal()
     try:
@@ -85,21 +98,20 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         if created:
             message_text = (
                 "🤖 Welcome to Neura Vault!\n\n"
-                "You are now subscribed. Tap the button below to get your first metrics update."
+                "You are now subscribed. Tap the button below to get your first metrics update.\n"
+                "Use /preferences to choose which rebalances you are notified about."
             )
         else:
             message_text = "👋 Welcome back! Tap the button for the latest metrics."
 
-    keyboard = [[InlineKeyboardButton("📊 Neura Metrics", callback_data='show_metrics')]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(message_text, reply_markup=reply_markup)
+    await update.message.reply_text(message_text, reply_markup=PERMANENT_REPLY_MARKUP)
 
 async def get_metrics_text() -> str:
     """
     Fetches data from the API using a double-checked locking pattern
     to prevent race conditions.
     """
-    global last_fetch, cached_metrics
+    global last_fetch, cached_metrics, cached_vault_data
 
     if cached_metrics and last_fetch and (datetime.now() - last_fetch).total_seconds() < CACHE_DURATION:
         logger.info("CACHE HIT - returning cached data (fast path)")
@@ -138,6 +150,7 @@ async def get_metrics_text() -> str:
 
             # Update the cache
             cached_metrics = result
+            cached_vault_data = vault_data
             last_fetch = datetime.now()
             return result
 
@@ -149,33 +162,181 @@ async def get_metrics_text() -> str:
                 return cached_metrics
             return "😕 Sorry, I couldn't fetch the metrics right now. Please try again later."
 
+def _remember_metrics_hash(chat_data: dict, message_id: int, digest: str | None = None) -> str | None:
+    """
+    Gets (or, with digest, sets) the hash of what a metrics message currently shows.
+    Only the newest few messages per chat are remembered.
+    """
+    hashes = chat_data.setdefault('metrics_hashes', {})
+    if digest is None:
+        return hashes.get(message_id)
+    hashes.pop(message_id, None)
+    hashes[message_id] = digest
+    while len(hashes) > METRICS_HASHES_PER_CHAT:
+        hashes.pop(next(iter(hashes)))
+    return digest
+
 async def show_metrics_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
-    Handles the press of the INLINE button.
-    It keeps the original message and sends a NEW one with the metrics and the permanent keyboard.
+    Handles the inline Refresh button (and the legacy welcome-message button).
+    It edits the message in place, and skips the Telegram call entirely when
+    the rendered metrics have not changed since this message was last drawn.
     """
     query = update.callback_query
-    #await query.answer("Fetching...")
-    await query.answer()
-    #await context.bot.send_chat_action(chat_id=query.message.chat_id, action=ChatAction.TYPING)
     metrics_text = await get_metrics_text()
+    digest = hashlib.sha256(metrics_text.encode()).hexdigest()
+    message_id = query.message.message_id
 
-    permanent_keyboard = [[KeyboardButton("📊 Neura Metrics")]]
-    permanent_reply_markup = ReplyKeyboardMarkup(permanent_keyboard, resize_keyboard=True)
+    if _remember_metrics_hash(context.chat_data, message_id) == digest:
+        await query.answer("Already up to date.")
+        return
 
-    await query.message.reply_text(
-        text=metrics_text,
-        reply_markup=permanent_reply_markup,
-        parse_mode='HTML'
-    )
+    await query.answer()
+    try:
+        await query.edit_message_text(text=metrics_text, reply_markup=METRICS_INLINE_MARKUP, parse_mode='HTML')
+    except BadRequest as e:
+        # Hashes are kept in memory, so after a restart we can still hit an unchanged message.
+        if "not modified" not in str(e).lower():
+            raise
+    _remember_metrics_hash(context.chat_data, message_id, digest)
 
-# --- THIS IS THE CHANGE ---
 async def show_metrics_from_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handles the press of the PERMANENT button by sending the metrics directly."""
+    """
+    Handles the press of the PERMANENT button by sending the metrics directly.
+    The message carries a Refresh button so later updates can be edited in place.
+    """
     # First, get the data. The user will see the "typing..." status.
     metrics_text = await get_metrics_text()
     # Then, send the final message in one go.
-    await update.message.reply_text(text=metrics_text, parse_mode='HTML')
+    message = await update.message.reply_text(text=metrics_text, reply_markup=METRICS_INLINE_MARKUP, parse_mode='HTML')
+    _remember_metrics_hash(context.chat_data, message.message_id, hashlib.sha256(metrics_text.encode()).hexdigest())
+
+# --- NOTIFICATION PREFERENCES ---
+MIN_AMOUNT_STEPS = [None, 1.0, 10.0, 100.0, 1000.0, 10000.0]  # In units of the token they are set on
+MUTE_WINDOWS = [None, (22, 7), (0, 8)]  # UTC hours, start inclusive, end exclusive
+
+async def get_preference_options() -> tuple[dict[str, str], dict[str, str]]:
+    """
+    Returns the tokens and protocols users can pick from, as {lowercase value: label},
+    taken from the cached vault list that also backs the metrics message.
+    """
+    await get_metrics_text()  # Refreshes cached_vault_data if it is stale
+    tokens, protocols = {}, {}
+    for vault in cached_vault_data or []:
+        if vault.get('token'):
+            tokens[str(vault['token']).lower()] = str(vault['token'])
+        if vault.get('protocol'):
+            protocols[str(vault['protocol']).lower()] = str(vault['protocol'])
+    return tokens, protocols
+
+def render_preferences(prefs: schemas.UserPreferences, tokens: dict[str, str], protocols: dict[str, str]) -> tuple[str, InlineKeyboardMarkup]:
+    """Builds the preferences message text and its inline keyboard."""
+    # Keep values the user is subscribed to even if the vault list no longer has them, so they can be removed.
+    tokens = {**{t: t for t in prefs.tokens}, **tokens}
+    protocols = {**{p: p for p in prefs.protocols}, **protocols}
+
+    def token_label(token: str) -> str:
+        minimum = prefs.token_min_amounts.get(token)
+        return f"{tokens[token]} (≥ {minimum:,g} {tokens[token]})" if minimum else tokens[token]
+
+    if prefs.mute_start_hour is not None and prefs.mute_end_hour is not None:
+        mute = f"{prefs.mute_start_hour:02d}:00–{prefs.mute_end_hour:02d}:00 UTC"
+    else:
+        mute = "Off"
+    text = (
+        "<b>🔔 Notification Preferences</b>\n\n"
+        f"<b>Tokens:</b> {', '.join(token_label(t) for t in prefs.tokens) or 'All'}\n"
+        f"<b>Protocols:</b> {', '.join(protocols[p] for p in prefs.protocols) or 'All'}\n"
+        f"<b>Quiet hours:</b> {mute}\n\n"
+        "Tap to toggle. With nothing selected you get every rebalance.\n"
+        "During quiet hours rebalances still arrive, just without a notification sound.\n"
+        "Minimum amounts are set per selected token, in units of that token."
+    )
+
+    def toggle_rows(kind: str, options: dict[str, str], selected: list[str]):
+        buttons = [
+            InlineKeyboardButton(f"{'✅' if value in selected else '▫️'} {label}", callback_data=f"pref:{kind}:{value}")
+            for value, label in sorted(options.items())
+        ]
+        return [buttons[i:i + 3] for i in range(0, len(buttons), 3)]
+
+    min_buttons = []
+    for token in prefs.tokens:
+        minimum = prefs.token_min_amounts.get(token)
+        label = f"≥ {minimum:,g} {tokens[token]}" if minimum else "Any"
+        min_buttons.append(InlineKeyboardButton(f"💰 Min {tokens[token]}: {label}", callback_data=f"pref:min:{token}"))
+
+    keyboard = [
+        *toggle_rows("token", tokens, prefs.tokens),
+        *[min_buttons[i:i + 2] for i in range(0, len(min_buttons), 2)],
+        *toggle_rows("protocol", protocols, prefs.protocols),
+        [
+            InlineKeyboardButton(f"🌙 Quiet: {mute}", callback_data="pref:mute"),
+            InlineKeyboardButton("↩️ Reset", callback_data="pref:reset"),
+        ],
+    ]
+    return text, InlineKeyboardMarkup(keyboard)
+
+def _next_step(steps: list, current):
+    return steps[(steps.index(current) + 1) % len(steps)] if current in steps else steps[1]
+
+async def show_preferences(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handles /preferences by sending the preferences message."""
+    chat_id = update.effective_chat.id
+    async with get_async_db() as db:
+        await asyncio.to_thread(crud.get_or_create_user, db, schemas.UserCreate(chat_id=chat_id))
+        prefs = await asyncio.to_thread(crud.get_user_preferences, db, chat_id)
+    text, reply_markup = render_preferences(prefs, *await get_preference_options())
+    await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup, parse_mode='HTML')
+
+async def preferences_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handles taps on the preferences keyboard. Applies the change and edits
+    the preferences message in place.
+    """
+    query = update.callback_query
+    await query.answer()
+    action = query.data.split(":", 2)[1:]
+    if action == ["open"]:
+        await show_preferences(update, context)
+        return
+
+    chat_id = query.message.chat_id
+    async with get_async_db() as db:
+        await asyncio.to_thread(crud.get_or_create_user, db, schemas.UserCreate(chat_id=chat_id))
+        prefs = await asyncio.to_thread(crud.get_user_preferences, db, chat_id)
+        if action[0] in ("token", "protocol") and len(action) == 2:
+            await asyncio.to_thread(crud.toggle_user_subscription, db, chat_id, action[0], action[1])
+        elif action[0] == "min" and len(action) == 2:
+            token = action[1]
+            await asyncio.to_thread(
+                crud.set_token_min_amount, db, chat_id, token,
+                _next_step(MIN_AMOUNT_STEPS, prefs.token_min_amounts.get(token)),
+            )
+        elif action == ["mute"]:
+            current = None
+            if prefs.mute_start_hour is not None and prefs.mute_end_hour is not None:
+                current = (prefs.mute_start_hour, prefs.mute_end_hour)
+            window = _next_step(MUTE_WINDOWS, current)
+            await asyncio.to_thread(
+                crud.update_user_preferences, db, chat_id,
+                mute_start_hour=window[0] if window else None,
+                mute_end_hour=window[1] if window else None,
+            )
+        elif action == ["reset"]:
+            await asyncio.to_thread(crud.reset_user_preferences, db, chat_id)
+        else:
+            logger.warning(f"Unknown preferences action: {query.data}")
+            return
+        prefs = await asyncio.to_thread(crud.get_user_preferences, db, chat_id)
+
+    text, reply_markup = render_preferences(prefs, *await get_preference_options())
+    try:
+        await query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode='HTML')
+    except BadRequest as e:
+        # e.g. Reset with nothing set renders the same message again.
+        if "not modified" not in str(e).lower():
+            raise
 
 def format_rebalancing_message(rebalance_event: dict) -> str | None:
     """Formats a rebalance event into a notification message."""
@@ -187,7 +348,7 @@ def format_rebalancing_message(rebalance_event: dict) -> str | None:
         #tx_hash = rebalance_event['deposit_transaction']['transaction_hash']
 
         deposit_hash = rebalance_event.get('deposit_transaction', {}).get('transaction_hash')
-        withdraw_hash = rebalance_event.get('withdrawal_transaction', {}).get('transaction_hash')
+        withdraw_hash = (rebalance_event.get('withdrawal_transaction') or {}).get('transaction_hash')
         tx_hash = deposit_hash or withdraw_hash
 
         strategy_summary = rebalance_event.get('strategy_summary', 'No summary provided.').strip().strip('"')
@@ -234,22 +395,53 @@ async def broadcast_rebalance_message(application: Application, message: str):
     logger.info(f"BROADCAST: Finished. {success_count}/{len(user_ids)} messages sent successfully.")
 '''
 
-async def broadcast_rebalance_message(application: Application, message: str):
+async def broadcast_rebalance_message(application: Application, message: str, rebalance_event: dict | None = None) -> datetime | None:
+    """
+    Sends the message to every user whose preferences match the rebalance event,
+    or to all users when no event is given. Users in their quiet hours get it silently.
+    Returns when the last successful send completed, or None if nothing was sent.
+    """
     logger.info("BROADCAST: Starting broadcast...")
+    rebalance_id = rebalance_event.get('rebalance_id') if rebalance_event else None
     async with get_async_db() as db:
-        user_ids = await asyncio.to_thread(crud.get_all_user_ids, db)
-        logger.info(f"BROADCAST: Found {len(user_ids)} users to notify.")
+        if rebalance_event:
+            recipients = await asyncio.to_thread(
+                crud.get_recipients, db,
+                token_symbol=rebalance_event['token_symbol'],
+                protocols=[rebalance_event['from_protocol'], rebalance_event['to_protocol']],
+                amount=float(rebalance_event['amount_token']),
+                hour=datetime.now(timezone.utc).hour,
+            )
+        else:
+            recipients = [(uid, False) for uid in await asyncio.to_thread(crud.get_all_user_ids, db)]
+        logger.info(f"BROADCAST: Found {len(recipients)} users to notify.")
     
-    if not user_ids:
+    if not recipients:
         logger.warning("BROADCAST: No users found, skipping broadcast.")
-        return
+        return None
 
-    tasks = [application.bot.send_message(chat_id=uid, text=message, parse_mode='Markdown') for uid in user_ids]
-    results = await asyncio.gather(*tasks, return_exceptions=True)
+    last_sent_at = None
+
+    async def send(uid: int, silent: bool):
+        nonlocal last_sent_at
+        result = await application.bot.send_message(
+            chat_id=uid, text=message, parse_mode='Markdown', disable_notification=silent
+        )
+        last_sent_at = datetime.now(timezone.utc)
+        return result
+
+    results = await asyncio.gather(*(send(uid, silent) for uid, silent in recipients), return_exceptions=True)
+
+    for (uid, _), res in zip(recipients, results):
+        if isinstance(res, Exception):
+            audit_log.record("message_failed", rebalance_id=rebalance_id, chat_id=uid, error=repr(res))
+        else:
+            audit_log.record("message_sent", rebalance_id=rebalance_id, chat_id=uid, message_id=res.message_id)
     
     success_count = sum(1 for res in results if not isinstance(res, Exception))
     failure_count = len(results) - success_count
     logger.info(f"BROADCAST: Finished. Success: {success_count}, Failures: {failure_count}.")
+    return last_sent_at
 
 '''
 async def check_and_notify_rebalance(application: Application):
@@ -366,12 +558,18 @@ async def lifespan(app: FastAPI):
     
     redis_pool = await create_pool(REDIS_SETTINGS)
     app.state.redis = redis_pool
+    audit_log.start()
 
     app.state.telegram_application = application
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CallbackQueryHandler(show_metrics_callback, pattern='^show_metrics$'))
-    application.add_handler(MessageHandler(filters.Text(["📊 Neura Metrics"]), show_metrics_from_text))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_generic_message))
+    application.add_handler(CommandHandler("start", timed_handler(start)))
+    application.add_handler(CommandHandler("preferences", timed_handler(show_preferences)))
+    application.add_handler(CallbackQueryHandler(timed_handler(show_metrics_callback), pattern='^(show_metrics|refresh_metrics)$'))
+    application.add_handler(CallbackQueryHandler(timed_handler(preferences_callback), pattern='^pref:'))
+    application.add_handler(MessageHandler(filters.Text(["📊 Neura Metrics"]), timed_handler(show_metrics_from_text)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(handle_generic_message)))
+
+    if profiling.PROFILING_ENABLED:
+        loop_monitor.start()
 
     await application.initialize()
     await application.start()
@@ -386,6 +584,8 @@ async def lifespan(app: FastAPI):
     yield
     logger.info("FastAPI app shutting down...")
     await app.state.redis.close()
+    await audit_log.stop()
+    await loop_monitor.stop()
     #rebalance_task.cancel()
     await application.updater.stop()
     await application.stop()
@@ -400,6 +600,9 @@ app = FastAPI(
     title="Telegram User API & Bot"
 )
 
+if profiling.PROFILING_ENABLED:
+    app.middleware("http")(profiling.time_request)
+
 class RebalanceWebhookPayload(BaseModel):
     rebalance_id: str
     amount_token: float
@@ -488,9 +691,17 @@ async def receive_rebalance_notification(
     """
     logger.info(f"WEBHOOK: Queuing job for rebalance event ID: {payload.rebalance_id}")
 
-    await redis.enqueue_job('process_rebalance', payload.dict())
+    # Record the receipt before touching Redis, so it is audited even if enqueuing fails.
+    audit_log.record("webhook_received", rebalance_id=payload.rebalance_id, payload=payload.dict())
+    try:
+        job = await redis.enqueue_job('process_rebalance', payload.dict())
+    except Exception as e:
+        logger.error(f"WEBHOOK: Failed to queue job for event {payload.rebalance_id}: {e}", exc_info=True)
+        audit_log.record("job_enqueue_failed", rebalance_id=payload.rebalance_id, error=repr(e))
+        raise
+    audit_log.record("job_enqueued", rebalance_id=payload.rebalance_id, job_id=job.job_id if job else None)
 
-    return {"status": "event accepted and queued"}
+    return {"status": "event accepted and queued", "job_id": job.job_id if job else None}
 
 @app.get("/users/ids/", response_model=List[int], tags=["Users"])
 def get_all_user_ids_endpoint(db: Session = Depends(get_db)):
@@ -525,3 +736,17 @@ def create_rebalance_event(event: schemas.RebalanceEventCreate, db: Session = De
         raise HTTPException(status_code=409, detail="Rebalance event already exists")
     return crud.create_rebalance_event(db=db, event=event)
 
+@app.get("/debug/profile", tags=["Debug"])
+async def profile_event_loop(
+    seconds: float = Query(5.0, gt=0, le=60),
+    api_key: str = Depends(get_api_key)
+):
+    """
+    Samples the event loop thread's stack for the given number of seconds and
+    returns the hottest frames. Only available when PROFILING_ENABLED is set.
+    """
+    if not profiling.PROFILING_ENABLED:
+        raise HTTPException(status_code=404, detail="Profiling is disabled")
+    report = await asyncio.to_thread(profiling.sample_profile, loop_monitor.loop_thread_id, seconds)
+    report["max_loop_lag_ms"] = round(loop_monitor.max_lag_ms, 1)
+    return report
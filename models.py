@@ -1,5 +1,5 @@
 # models.py
-from sqlalchemy import Column, BigInteger, DateTime, Integer, String
+from sqlalchemy import Column, BigInteger, DateTime, Float, ForeignKey, Index, Integer, JSON, String
 from sqlalchemy.sql import func
 from database import Base
 
@@ -9,6 +9,36 @@ class User(Base):
     chat_id = Column(BigInteger, primary_key=True, index=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
+class UserPreference(Base):
+    """
+    Per-user quiet hours. Rebalances in the window are still delivered, but
+    silently (no notification sound). A user without a row here has no quiet hours.
+    Mute hours are in UTC; a window may wrap midnight (e.g. 22 -> 7).
+    """
+    __tablename__ = "user_preferences"
+
+    chat_id = Column(BigInteger, ForeignKey("users.chat_id", ondelete="CASCADE"), primary_key=True)
+    mute_start_hour = Column(Integer, nullable=True)
+    mute_end_hour = Column(Integer, nullable=True)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+class UserSubscription(Base):
+    """
+    One row per token or protocol a user opted into (kind is "token" or "protocol").
+    Values are stored lowercased. No rows of a kind means "all" for that kind.
+    min_amount only applies to token rows and is in units of that token, so
+    each token gets its own threshold.
+    """
+    __tablename__ = "user_subscriptions"
+    __table_args__ = (
+        Index("ix_user_subscriptions_kind_value", "kind", "value"),
+    )
+
+    chat_id = Column(BigInteger, ForeignKey("users.chat_id", ondelete="CASCADE"), primary_key=True)
+    kind = Column(String, primary_key=True)
+    value = Column(String, primary_key=True)
+    min_amount = Column(Float, nullable=True)
+
 class RebalanceEvent(Base):
     """
     Stores a record of rebalance events for which notifications have been sent.
@@ -19,3 +49,18 @@ class RebalanceEvent(Base):
     rebalance_id = Column(String, unique=True, index=True, nullable=False)
     transaction_hash = Column(String, unique=True, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class AuditEvent(Base):
+    """
+    Append-only record of webhook receipts, job state changes and per-send outcomes.
+    Rows are written in batches by the AuditLog buffer, so created_at is set by the
+    writer at record time rather than by the database at flush time.
+    """
+    __tablename__ = "audit_events"
+
+    id = Column(BigInteger, primary_key=True, index=True)
+    event_type = Column(String, index=True, nullable=False)
+    rebalance_id = Column(String, index=True, nullable=True)
+    chat_id = Column(BigInteger, nullable=True)
+    detail = Column(JSON, nullable=True)
+    created_at = Column(DateTime(timezone=True), nullable=False)
@@ -0,0 +1,168 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+import functools
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# Everything in this module is opt-in. With PROFILING_ENABLED unset the wrappers
+# return the original callables and nothing is started.
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() in ("1", "true", "yes")
+SLOW_HANDLER_THRESHOLD_MS = float(os.getenv("SLOW_HANDLER_THRESHOLD_MS", 500))
+LOOP_LAG_INTERVAL_SECONDS = float(os.getenv("LOOP_LAG_INTERVAL_SECONDS", 0.5))
+LOOP_LAG_THRESHOLD_MS = float(os.getenv("LOOP_LAG_THRESHOLD_MS", 100))
+PROFILE_SAMPLE_INTERVAL_SECONDS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_SECONDS", 0.02))
+
+
+def timed_handler(callback):
+    """
+    Wraps a Telegram handler callback so each call is timed.
+    Calls slower than SLOW_HANDLER_THRESHOLD_MS are logged as warnings.
+    """
+    if not PROFILING_ENABLED:
+        return callback
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            if elapsed_ms >= SLOW_HANDLER_THRESHOLD_MS:
+                logger.warning(f"PROFILE: Slow handler {callback.__name__} took {elapsed_ms:.1f} ms.")
+            else:
+                logger.debug(f"PROFILE: Handler {callback.__name__} took {elapsed_ms:.1f} ms.")
+
+    return wrapper
+
+
+async def time_request(request, call_next):
+    """FastAPI HTTP middleware that logs slow routes the same way timed_handler does."""
+    started = time.perf_counter()
+    try:
+        return await call_next(request)
+    finally:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        route = f"{request.method} {request.url.path}"
+        if elapsed_ms >= SLOW_HANDLER_THRESHOLD_MS:
+            logger.warning(f"PROFILE: Slow route {route} took {elapsed_ms:.1f} ms.")
+        else:
+            logger.debug(f"PROFILE: Route {route} took {elapsed_ms:.1f} ms.")
+
+
+class LoopMonitor:
+    """
+    Measures event loop lag and captures the stack of whatever is blocking it.
+
+    A heartbeat task sleeps for a fixed interval and logs how late it woke up.
+    A watchdog thread watches that heartbeat; if it goes stale for longer than
+    the lag threshold, the loop is stalled right now, so the watchdog logs the
+    loop thread's current stack, which points at the blocking call.
+    """
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL_SECONDS, threshold_ms: float = LOOP_LAG_THRESHOLD_MS):
+        self.interval = interval
+        self.threshold = threshold_ms / 1000
+        self.loop_thread_id: int | None = None
+        self.max_lag_ms = 0.0
+        self._last_beat = time.monotonic()
+        self._task: asyncio.Task | None = None
+        self._watchdog: threading.Thread | None = None
+        self._stopping = threading.Event()
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._last_beat = now
+            lag_ms = (now - expected) * 1000
+            self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+            if lag_ms >= self.threshold * 1000:
+                logger.warning(f"PROFILE: Event loop lag {lag_ms:.1f} ms.")
+
+    def _watch(self):
+        reported_beat = None
+        while not self._stopping.wait(self.threshold / 2):
+            last_beat = self._last_beat
+            stalled_for = time.monotonic() - last_beat - self.interval
+            # Report each stall once, while it is still happening.
+            if stalled_for >= self.threshold and reported_beat != last_beat:
+                reported_beat = last_beat
+                frame = sys._current_frames().get(self.loop_thread_id)
+                stack = "".join(traceback.format_stack(frame)) if frame else "<loop thread not found>"
+                logger.warning(f"PROFILE: Event loop blocked for {stalled_for * 1000:.1f} ms. Stack:\n{stack}")
+
+    def start(self) -> None:
+        """Starts the heartbeat on the running loop and the watchdog thread."""
+        if self._task is not None:
+            return
+        self.loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stopping.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+        logger.info(
+            f"PROFILE: Loop monitor started (interval {self.interval}s, threshold {self.threshold * 1000:.0f} ms)."
+        )
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._stopping.set()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        logger.info(f"PROFILE: Loop monitor stopped. Max lag seen: {self.max_lag_ms:.1f} ms.")
+
+
+def _collapse_stack(frame) -> list[str]:
+    """Root-first frame labels, read straight off the frame objects (no source line lookups)."""
+    entries = []
+    while frame is not None:
+        code = frame.f_code
+        entries.append(f"{code.co_filename}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    entries.reverse()
+    return entries
+
+
+def sample_profile(thread_id: int, seconds: float, interval: float = PROFILE_SAMPLE_INTERVAL_SECONDS, top: int = 25) -> dict:
+    """
+    Statistical profile of one thread: samples its stack every `interval` seconds
+    for `seconds` seconds. Blocking; run it off the loop with asyncio.to_thread.
+    Returns the most frequent stacks (collapsed, root first) and the functions
+    seen on top of the stack most often.
+    """
+    stacks = Counter()
+    leaves = Counter()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            entries = _collapse_stack(frame)
+            stacks[";".join(entries)] += 1
+            leaves[entries[-1]] += 1
+            samples += 1
+        time.sleep(interval)
+    return {
+        "seconds": seconds,
+        "interval": interval,
+        "samples": samples,
+        "top_functions": [{"frame": k, "samples": v} for k, v in leaves.most_common(top)],
+        "top_stacks": [{"stack": k, "samples": v} for k, v in stacks.most_common(top)],
+    }
+
+
+loop_monitor = LoopMonitor()
@@ -0,0 +1,488 @@
+"""
+Offline replay tool for /webhook/rebalance traffic.
+
+    python replay.py record capture.ndjson --since 2026-10-01T00:00:00
+    python replay.py replay capture.ndjson --speed 10 --seed-users 5000
+
+`record` exports the webhook payloads kept by the audit log (webhook_received
+events) into an NDJSON capture, one {"received_at", "payload"} object per line.
+
+`replay` posts each captured payload to the real webhook endpoint, in-process,
+at the original pace (--speed 1), scaled (--speed N) or as fast as possible
+(--speed max). An in-process ARQ worker runs process_rebalance against a local
+fake Telegram Bot API, so nothing reaches real users. It then reports webhook-to-
+last-send latency, queue depth over time and how many duplicates were caught.
+
+The replay writes to DATABASE_URL (rebalance_events, audit_events, and users
+with --seed-users) and deletes those rows again when it finishes, unless
+--keep-data is given. It refuses a non-local database or Redis unless
+--allow-remote-db / --allow-remote-redis is given.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import logging
+import statistics
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from urllib.parse import parse_qs
+
+logger = logging.getLogger("replay")
+
+REPLAY_QUEUE_NAME = "arq:replay-queue"
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+# Telegram IDs have at most 52 significant bits; these fit in BIGINT but can never be real.
+SEED_CHAT_ID_BASE = 2 ** 62
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Record and replay rebalance webhook traffic.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    record = sub.add_parser("record", help="Export captured webhook payloads from the audit log.")
+    record.add_argument("output", help="NDJSON file to write.")
+    record.add_argument("--since", type=datetime.fromisoformat, help="ISO timestamp, inclusive.")
+    record.add_argument("--until", type=datetime.fromisoformat, help="ISO timestamp, exclusive.")
+    record.add_argument("--limit", type=int)
+
+    replay = sub.add_parser("replay", help="Replay a capture through the webhook and worker pipeline.")
+    replay.add_argument("capture", help="NDJSON capture file.")
+    replay.add_argument("--speed", default="1", help="Time scale factor (2 = twice as fast) or 'max'.")
+    replay.add_argument("--redis-url", default="redis://localhost:6379")
+    replay.add_argument("--allow-remote-redis", action="store_true")
+    replay.add_argument("--allow-remote-db", action="store_true", help="Allow a non-local DATABASE_URL.")
+    replay.add_argument("--keep-data", action="store_true",
+                        help="Keep seeded users, rebalance events and audit rows created by the run.")
+    replay.add_argument("--telegram-port", type=int, default=8081, help="Port for the fake Telegram Bot API.")
+    replay.add_argument("--send-latency-ms", type=float, default=30, help="Simulated Telegram latency per call.")
+    replay.add_argument("--seed-users", type=int, default=0, help="Create this many fake subscribers first.")
+    replay.add_argument("--fresh-ids", action="store_true",
+                        help="Suffix rebalance IDs and tx hashes with a run tag so earlier runs do not count as duplicates.")
+    replay.add_argument("--max-jobs", type=int, default=10, help="Worker concurrency.")
+    replay.add_argument("--sample-interval", type=float, default=0.25, help="Queue depth sampling interval (s).")
+    replay.add_argument("--timeout", type=float, default=600, help="Give up waiting for jobs after this many seconds.")
+    replay.add_argument("--report", help="Also write the full report (with timelines) to this JSON file.")
+
+    args = parser.parse_args(argv)
+    if args.command == "replay" and args.speed != "max":
+        try:
+            if float(args.speed) <= 0:
+                raise ValueError
+        except ValueError:
+            parser.error("--speed must be a positive number or 'max'")
+    return args
+
+
+# --- RECORD ---
+
+async def record_capture(args) -> int:
+    import crud
+    from database import get_async_db
+
+    async with get_async_db() as db:
+        events = await asyncio.to_thread(
+            crud.get_audit_events, db, "webhook_received", since=args.since, until=args.until, limit=args.limit
+        )
+    written = 0
+    with open(args.output, "w") as f:
+        for event in events:
+            payload = (event.detail or {}).get("payload")
+            if not payload:
+                continue
+            f.write(json.dumps({"received_at": event.created_at.isoformat(), "payload": payload}) + "\n")
+            written += 1
+    logger.info(f"RECORD: Wrote {written} webhook payloads to {args.output}.")
+    return written
+
+
+# --- FAKE TELEGRAM ---
+
+class FakeTelegramStats:
+    def __init__(self):
+        self.sends = 0
+        self.send_times: list[float] = []
+        self.calls = Counter()
+
+
+def build_fake_telegram(stats: FakeTelegramStats, latency_ms: float):
+    """A minimal Bot API: answers getMe and sendMessage, and accepts anything else."""
+    from fastapi import FastAPI, Request
+
+    fake = FastAPI()
+
+    @fake.post("/bot{token}/{method}")
+    async def bot_method(token: str, method: str, request: Request):
+        body = await request.body()
+        if request.headers.get("content-type", "").startswith("application/json"):
+            params = json.loads(body or b"{}")
+        else:
+            params = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+        stats.calls[method] += 1
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000)
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Replay", "username": "replay_bot"}
+        elif method == "sendMessage":
+            stats.sends += 1
+            stats.send_times.append(time.time())
+            result = {
+                "message_id": stats.sends,
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        return {"ok": True, "result": result}
+
+    return fake
+
+
+# --- REPLAY ---
+
+def load_capture(path: str, fresh_ids: bool) -> list[tuple[datetime, dict]]:
+    run_tag = uuid.uuid4().hex[:8]
+    records = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            payload = item["payload"]
+            if fresh_ids:
+                payload["rebalance_id"] = f"{payload['rebalance_id']}-{run_tag}"
+                for key in ("deposit_transaction", "withdrawal_transaction"):
+                    tx = payload.get(key)
+                    if tx and tx.get("transaction_hash"):
+                        tx["transaction_hash"] = f"{tx['transaction_hash']}{run_tag}"
+            records.append((datetime.fromisoformat(item["received_at"]), payload))
+    records.sort(key=lambda r: r[0])
+    return records
+
+
+def percentile(values: list[float], pct: int) -> float | None:
+    if not values:
+        return None
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[pct - 1]
+
+
+def check_local_database(allow_remote: bool) -> None:
+    """Refuses to run against a non-local DATABASE_URL unless explicitly allowed."""
+    from dotenv import load_dotenv
+    from sqlalchemy.engine import make_url
+
+    load_dotenv()  # Same source database.py reads DATABASE_URL from
+    if not os.getenv("DATABASE_URL"):
+        raise SystemExit("DATABASE_URL is not set.")
+    host = make_url(os.environ["DATABASE_URL"]).host
+    if host not in (None, *LOCAL_HOSTS) and not allow_remote:
+        raise SystemExit(f"Refusing to replay against non-local database {host}; pass --allow-remote-db.")
+
+
+async def seed_users(count: int) -> list[int]:
+    """Creates fake subscribers and returns the chat IDs that did not exist before."""
+    import crud
+    import schemas
+    from database import get_async_db
+
+    def create_all(db):
+        created_ids = []
+        for i in range(count):
+            _, created = crud.get_or_create_user(db, schemas.UserCreate(chat_id=SEED_CHAT_ID_BASE + i))
+            if created:
+                created_ids.append(SEED_CHAT_ID_BASE + i)
+        return created_ids
+
+    async with get_async_db() as db:
+        created_ids = await asyncio.to_thread(create_all, db)
+    logger.info(f"REPLAY: Seeded {len(created_ids)} fake subscribers.")
+    return created_ids
+
+
+async def cleanup(replay_ids: list[str], created_ids: list[str], seeded_ids: list[int], since: datetime) -> None:
+    """
+    Removes the rows this run created: seeded users, rebalance events that did not
+    exist before the run (created_ids), and every audit event recorded since the run
+    started for any replayed ID (replay_ids), including IDs that were already known.
+    """
+    import crud
+    from database import get_async_db
+
+    async with get_async_db() as db:
+        users = await asyncio.to_thread(crud.delete_users, db, seeded_ids) if seeded_ids else 0
+        events = await asyncio.to_thread(crud.delete_rebalance_events, db, created_ids) if created_ids else 0
+        audits = await asyncio.to_thread(crud.delete_audit_events, db, replay_ids, since) if replay_ids else 0
+    logger.info(f"REPLAY: Cleaned up {users} users, {events} rebalance events and {audits} audit events.")
+
+
+async def run_replay(args) -> dict:
+    from arq.connections import RedisSettings
+
+    redis_settings = RedisSettings.from_dsn(args.redis_url)
+    if redis_settings.host not in LOCAL_HOSTS and not args.allow_remote_redis:
+        raise SystemExit(f"Refusing to replay against non-local Redis {redis_settings.host}; pass --allow-remote-redis.")
+    check_local_database(args.allow_remote_db)
+
+    # main.py refuses to import without a bot token; the replay never talks to the real API.
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "0:replay")
+    import crud
+    from database import get_async_db
+
+    records = load_capture(args.capture, args.fresh_ids)
+    if not records:
+        raise SystemExit(f"No payloads in {args.capture}.")
+
+    replay_ids = sorted({payload["rebalance_id"] for _, payload in records})
+    run_started_at = datetime.now(timezone.utc)
+    async with get_async_db() as db:
+        preexisting_ids = await asyncio.to_thread(crud.get_existing_rebalance_ids, db, replay_ids)
+
+    seeded_ids = []
+    try:
+        if args.seed_users:
+            seeded_ids = await seed_users(args.seed_users)
+        return await replay_through_pipeline(args, records, redis_settings, run_started_at, preexisting_ids)
+    finally:
+        created_ids = [rebalance_id for rebalance_id in replay_ids if rebalance_id not in preexisting_ids]
+        if args.keep_data:
+            logger.info("REPLAY: --keep-data given, leaving replay rows in the database.")
+        else:
+            await cleanup(replay_ids, created_ids, seeded_ids, run_started_at)
+
+
+async def replay_through_pipeline(
+    args, records, redis_settings, run_started_at: datetime, preexisting_ids: set[str]
+) -> dict:
+    import httpx
+    import uvicorn
+    from arq import create_pool
+    from arq.jobs import Job
+    from arq.worker import Worker
+    from telegram.ext import Application
+
+    import crud
+    import main
+    from audit import audit_log
+    from database import get_async_db
+    from worker import process_rebalance
+
+    stats = FakeTelegramStats()
+    server = uvicorn.Server(uvicorn.Config(
+        build_fake_telegram(stats, args.send_latency_ms), host="127.0.0.1", port=args.telegram_port, log_level="warning"
+    ))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    application = (
+        Application.builder()
+        .token(os.environ["TELEGRAM_BOT_TOKEN"])
+        .base_url(f"http://127.0.0.1:{args.telegram_port}/bot")
+        .build()
+    )
+    await application.initialize()
+
+    redis = await create_pool(redis_settings, default_queue_name=REPLAY_QUEUE_NAME)
+    main.app.state.redis = redis
+    audit_log.start()
+    worker = Worker(
+        functions=[process_rebalance],
+        redis_settings=redis_settings,
+        queue_name=REPLAY_QUEUE_NAME,
+        ctx={"telegram_application": application},
+        max_jobs=args.max_jobs,
+        poll_delay=0.05,
+        handle_signals=False,
+    )
+    worker_task = asyncio.create_task(worker.async_run())
+
+    depth_timeline: list[tuple[float, int]] = []
+    started = time.time()
+
+    async def sample_depth():
+        while True:
+            depth_timeline.append((round(time.time() - started, 3), await redis.zcard(REPLAY_QUEUE_NAME)))
+            await asyncio.sleep(args.sample_interval)
+
+    sampler_task = asyncio.create_task(sample_depth())
+
+    posted = []  # (rebalance_id, job_id, posted_at)
+    rejected = Counter()
+    results = {}
+    pending = set()
+    try:
+        speed = None if args.speed == "max" else float(args.speed)
+        first_received = records[0][0]
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://replay") as client:
+            for received_at, payload in records:
+                if speed:
+                    due = started + (received_at - first_received).total_seconds() / speed
+                    await asyncio.sleep(max(0.0, due - time.time()))
+                posted_at = datetime.now(timezone.utc)
+                response = await client.post(
+                    "/webhook/rebalance", json=payload, headers={"x-api-key": main.WEBHOOK_API_KEY}
+                )
+                if response.status_code != 202:
+                    rejected[response.status_code] += 1
+                    continue
+                posted.append((payload["rebalance_id"], response.json().get("job_id"), posted_at))
+        logger.info(f"REPLAY: Posted {len(posted)} payloads ({sum(rejected.values())} rejected). Waiting for jobs...")
+
+        deadline = time.time() + args.timeout
+        pending = {job_id for _, job_id, _ in posted if job_id}
+        while pending and time.time() < deadline:
+            for job_id in list(pending):
+                info = await Job(job_id, redis, _queue_name=REPLAY_QUEUE_NAME).result_info()
+                if info is not None:
+                    results[job_id] = info
+                    pending.discard(job_id)
+            if pending:
+                await asyncio.sleep(args.sample_interval)
+    finally:
+        sampler_task.cancel()
+        worker_task.cancel()
+        for task in (sampler_task, worker_task):
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await worker.close()
+        await audit_log.stop()
+        await redis.close()
+        await application.shutdown()
+        server.should_exit = True
+        await server_task
+
+    # The worker records when each job's last message went out; read it back from the flushed audit log.
+    async with get_async_db() as db:
+        completions = await asyncio.to_thread(crud.get_audit_events, db, "job_completed", since=run_started_at)
+    last_sent = {
+        event.detail["job_id"]: datetime.fromisoformat(event.detail["last_sent_at"])
+        for event in completions
+        if event.detail and event.detail.get("job_id") and event.detail.get("last_sent_at")
+    }
+
+    return build_report(
+        records, preexisting_ids, posted, rejected, results, last_sent, pending, stats, depth_timeline, started
+    )
+
+
+def build_report(
+    records, preexisting_ids, posted, rejected, results, last_sent, pending, stats, depth_timeline, started
+) -> dict:
+    outcomes = Counter()
+    latencies = []
+    for _, job_id, posted_at in posted:
+        info = results.get(job_id)
+        if info is None:
+            outcomes["unfinished"] += 1
+            continue
+        outcomes[info.result if info.success else "failed"] += 1
+        # Only jobs that actually broadcast have a "last message sent"; duplicates and
+        # format failures would otherwise pull the percentiles down.
+        if info.success and info.result == "sent" and job_id in last_sent:
+            latencies.append((last_sent[job_id] - posted_at).total_seconds() * 1000)
+
+    # Every payload whose ID was already in the database, and every repeat of an ID
+    # within the capture, should be caught as a duplicate.
+    already_processed = 0
+    duplicates_in_capture = 0
+    seen = set()
+    for _, payload in records:
+        rebalance_id = payload["rebalance_id"]
+        if rebalance_id in preexisting_ids:
+            already_processed += 1
+        elif rebalance_id in seen:
+            duplicates_in_capture += 1
+        else:
+            seen.add(rebalance_id)
+    expected_duplicates = already_processed + duplicates_in_capture
+    depths = [depth for _, depth in depth_timeline]
+    per_second = Counter(int(t) for t in stats.send_times)
+    last_send = max(stats.send_times) if stats.send_times else None
+
+    return {
+        "payloads": len(records),
+        "accepted": len(posted),
+        "rejected": dict(rejected),
+        "outcomes": dict(outcomes),
+        "dedup": {
+            "duplicates_in_capture": duplicates_in_capture,
+            "already_processed": already_processed,
+            "expected_duplicates": expected_duplicates,
+            "duplicates_caught": outcomes.get("duplicate", 0),
+            "effectiveness": (
+                round(outcomes.get("duplicate", 0) / expected_duplicates, 3) if expected_duplicates else None
+            ),
+        },
+        "latency_samples": len(latencies),
+        "latency_ms": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies) if latencies else None,
+        },
+        "first_receipt_to_last_send_s": round(last_send - started, 3) if last_send else None,
+        "telegram": {
+            "messages_sent": stats.sends,
+            "peak_per_second": max(per_second.values()) if per_second else 0,
+            "calls": dict(stats.calls),
+        },
+        "queue_depth": {
+            "max": max(depths) if depths else 0,
+            "mean": round(statistics.fmean(depths), 2) if depths else 0,
+            "timeline": depth_timeline,
+        },
+        "unfinished_jobs": len(pending),
+    }
+
+
+def print_report(report: dict) -> None:
+    latency = report["latency_ms"]
+
+    def ms(value):
+        return f"{value:.1f} ms" if value is not None else "n/a"
+
+    print(f"Payloads:          {report['payloads']} ({report['accepted']} accepted, rejected: {report['rejected'] or 0})")
+    print(f"Job outcomes:      {report['outcomes']}")
+    dedup = report["dedup"]
+    print(f"Dedup:             {dedup['duplicates_caught']} caught / {dedup['expected_duplicates']} expected "
+          f"({dedup['duplicates_in_capture']} repeats in capture, {dedup['already_processed']} already in the database)")
+    print(f"Latency (receipt -> last send, {report['latency_samples']} sent jobs): p50 {ms(latency['p50'])}, p95 {ms(latency['p95'])}, "
+          f"p99 {ms(latency['p99'])}, max {ms(latency['max'])}")
+    print(f"First receipt to last send: {report['first_receipt_to_last_send_s']} s")
+    print(f"Telegram sends:    {report['telegram']['messages_sent']} "
+          f"(peak {report['telegram']['peak_per_second']}/s)")
+    print(f"Queue depth:       max {report['queue_depth']['max']}, mean {report['queue_depth']['mean']}")
+    if report["unfinished_jobs"]:
+        print(f"WARNING: {report['unfinished_jobs']} jobs did not finish before the timeout.")
+
+
+def cli(argv=None) -> int:
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    args = parse_args(argv)
+    if args.command == "record":
+        asyncio.run(record_capture(args))
+        return 0
+
+    report = asyncio.run(run_replay(args))
+    print_report(report)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+    return 1 if report["unfinished_jobs"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
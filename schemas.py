@@ -14,6 +14,13 @@ class User(UserBase):
     class Config:
         from_attributes = True
 
+class UserPreferences(BaseModel):
+    tokens: list[str] = []
+    protocols: list[str] = []
+    token_min_amounts: dict[str, float] = {}
+    mute_start_hour: int | None = None
+    mute_end_hour: int | None = None
+
 class RebalanceEventBase(BaseModel):
     rebalance_id: str
     transaction_hash: str
@@ -5,6 +5,9 @@ from telegram.ext import Application
 
 import crud
 import schemas
+from audit import audit_log
+import profiling
+from profiling import loop_monitor
 from main import (
     TELEGRAM_TOKEN, REDIS_SETTINGS, format_rebalancing_message, 
     broadcast_rebalance_message
@@ -29,6 +32,9 @@ async def on_startup(ctx):
     # Store the application instance in the worker's context
     ctx['telegram_application'] = application
     logger.info("Telegram application initialized in worker.")
+    audit_log.start()
+    if profiling.PROFILING_ENABLED:
+        loop_monitor.start()
 
 async def on_shutdown(ctx):
     """This runs once when the worker shuts down."""
@@ -38,21 +44,25 @@ async def on_shutdown(ctx):
         await application.stop()
         await application.shutdown()
     logger.info("Telegram application shut down in worker.")
+    await audit_log.stop()
+    await loop_monitor.stop()
 
 
 async def process_rebalance(ctx, payload: dict):
     """
     This is the background job that processes the rebalance event.
     ARQ will call this function for every job in the queue.
+    Returns "sent", "duplicate" or "format_failed", which ARQ keeps as the job result.
     """
     rebalance_id = payload.get('rebalance_id', 'N/A')
     logger.info(f"WORKER: Processing job for rebalance event ID: {rebalance_id}")
+    audit_log.record("job_started", rebalance_id=rebalance_id, job_id=ctx.get('job_id'), job_try=ctx.get('job_try'))
     
     # Get the Telegram application from the context we created on startup
     application = ctx['telegram_application']
 
     deposit_hash = payload.get('deposit_transaction', {}).get('transaction_hash')
-    withdrawal_hash = payload.get('withdrawal_transaction', {}).get('transaction_hash')
+    withdrawal_hash = (payload.get('withdrawal_transaction') or {}).get('transaction_hash')
 
     tx_hash = deposit_hash or withdrawal_hash
 
@@ -61,7 +71,8 @@ async def process_rebalance(ctx, payload: dict):
         event_exists = await asyncio.to_thread(crud.get_rebalance_event_by_rebalance_id, db, rebalance_id)
         if event_exists:
             logger.warning(f"WORKER: Event {rebalance_id} already processed. Job skipped.")
-            return # Exit gracefully
+            audit_log.record("job_skipped_duplicate", rebalance_id=rebalance_id, job_id=ctx.get('job_id'))
+            return "duplicate" # Exit gracefully
 
         # If not, save it now before we try to notify
         #tx_hash = payload.get('deposit_transaction', {}).get('transaction_hash') or "missing_hash"
@@ -73,14 +84,21 @@ async def process_rebalance(ctx, payload: dict):
     if not message:
         # If formatting fails, we can't proceed.
         logger.error(f"WORKER: Failed to format message for event {rebalance_id}. Aborting job.")
-        return
+        audit_log.record("job_aborted", rebalance_id=rebalance_id, job_id=ctx.get('job_id'), reason="format_failed")
+        return "format_failed"
 
     # 3. Broadcast the message
     try:
-        await broadcast_rebalance_message(application, message)
+        last_sent_at = await broadcast_rebalance_message(application, message, rebalance_event=payload)
         logger.info(f"WORKER: Successfully broadcasted message for event {rebalance_id}.")
+        audit_log.record(
+            "job_completed", rebalance_id=rebalance_id, job_id=ctx.get('job_id'),
+            last_sent_at=last_sent_at.isoformat() if last_sent_at else None,
+        )
+        return "sent"
     except Exception as e:
         logger.error(f"WORKER: Broadcast failed for event {rebalance_id}: {e}", exc_info=True)
+        audit_log.record("job_failed", rebalance_id=rebalance_id, job_id=ctx.get('job_id'), error=repr(e))
         # ARQ will retry the job automatically based on its settings
         raise # Re-raise the exception to trigger a retry
 